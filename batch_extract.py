@@ -1,115 +1,266 @@
-import os, io, re, csv, json, glob, time, asyncio
+import os, re, csv, asyncio, tempfile, logging, logging.handlers, queue, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
 from typing import List
+
+# one OCR process per core — keep Tesseract's own OpenMP from oversubscribing them
+# (must be set before tesserocr loads libtesseract below)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import cv2
+import numpy as np
 from PIL import Image
-from pdf2image import convert_from_bytes
-import pytesseract
+from pdf2image import convert_from_path
+from tesserocr import PyTessBaseAPI, PSM, OEM
 from dateutil import parser
+from blake3 import blake3
+import orjson
+try:
+    import re2  # linear-time DFA matching; immune to backtracking blowups on noisy OCR
+except ImportError:
+    re2 = re
 
-from llm_extract import extract_openai
+from llm_extract import FIELDS, extract_openai, extract_openai_close, extract_openai_warmup
+from llm_batch import extract_openai_batch
 
 OUT_DIR = "outputs"
 JSON_DIR = os.path.join(OUT_DIR, "json")
 DEBUG_DIR = os.path.join(OUT_DIR, "debug")
 WAYBILLS_CSV = os.path.join(OUT_DIR, "waybills.csv")
+OCR_CACHE_DIR = os.path.join(OUT_DIR, ".ocr_cache")
+# part of every cache key: bump whenever rendering, _preprocess or the Tesseract
+# PSM/OEM settings change, so old text is never served for the new pipeline
+OCR_CACHE_VERSION = "1"
 
 os.makedirs(JSON_DIR, exist_ok=True)
 os.makedirs(DEBUG_DIR, exist_ok=True)
 
-DATE_RE = re.compile(r"\b(\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}-\d{2}-\d{2})\b")
+# the pattern-matchable fields as two alternations, each walked once with finditer;
+# every branch has exactly one named group, so m.lastgroup is the field it matched.
+# Case-insensitivity is inline (?i): re2 takes no re.I-style flags.
+HEADER_RE = re2.compile(
+    r"(?i)\b(?P<date>\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}-\d{2}-\d{2})\b"
+    r"|\b(?:waybill|bol|b/l|shipment)\s*(?:#|no\.?)\s*(?P<waybill_number>[A-Z0-9-]{4,})"
+    r"|\bticket\s*(?:#|no\.?)\s*(?P<ticket_number>[A-Z0-9-]{3,})"
+    r"|\b(?:cust\s+)?p\.?o\.?\s*(?:#|no\.?)\s*(?P<po_number>[A-Z0-9-]{3,})"
+)
+WEIGHT_RE = re2.compile(
+    r"(?i)\bgross(?:\s*wt\.?)?[\s:|]*(?P<gross_weight>\d[\d,]{1,8})\b"
+    r"|\btare(?:\s*wt\.?)?[\s:|]*(?P<tare_weight>\d[\d,]{1,8})\b"
+    r"|\bnet(?:\s*wt\.?)?[\s:|]*(?P<net_weight>\d[\d,]{1,8})\b"
+)
+HEADER_CHARS = 4096  # ids and dates sit in the document header; weights can be anywhere
+WEIGHT_FIELDS = {"gross_weight", "tare_weight", "net_weight"}
 
+@lru_cache(maxsize=4096)  # the same few dates repeat across a shipment batch
 def to_iso_date(s: str | None) -> str | None:
     if not s: return None
+    if len(s) == 10 and s[4] == "-":
+        try:
+            return date.fromisoformat(s).isoformat()  # C fast path; dateutil is slow
+        except ValueError:
+            pass
     try:
         return parser.parse(s, dayfirst=False).date().isoformat()
     except Exception:
         return None
 
-def _ocr_image(im: Image.Image) -> str:
+_POOL: ProcessPoolExecutor | None = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # workers fork lazily on the first map, which happens under asyncio.to_thread with
+        # the loop and log-listener threads live; forking a threaded process can deadlock
+        # the child, so start them from a clean forkserver (spawn where that's missing)
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=ctx)
+    return _POOL
+
+def _shutdown_pool() -> None:
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown()
+        _POOL = None
+
+_API: PyTessBaseAPI | None = None
+
+def _get_api() -> PyTessBaseAPI:
+    # one long-lived engine per worker process: the model loads once, not once per page
+    global _API
+    if _API is None:
+        _API = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+    return _API
+
+# only oversized raster inputs (phone photos, 300+ DPI scans) hit this: a letter page
+# rendered at 200 DPI is 1700 px wide. 2200 px is still well above Tesseract's ideal x-height.
+OCR_MAX_WIDTH = 2200
+
+def _preprocess(im: Image.Image) -> np.ndarray:
     im = im.convert("L")  # grayscale
-    cfg = "--oem 1 --psm 6"
-    return pytesseract.image_to_string(im, config=cfg)
+    if im.width > OCR_MAX_WIDTH:
+        im.thumbnail((OCR_MAX_WIDTH, im.height), Image.LANCZOS)
+    # binarise up front: Tesseract runs faster on clean black-on-white pages
+    arr = np.asarray(im)
+    return cv2.adaptiveThreshold(arr, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+
+def _ocr_image(im: Image.Image) -> str:
+    api = _get_api()
+    # hand Tesseract the raw 8-bit buffer; SetImage(PIL) would round-trip through PIL again
+    arr = _preprocess(im)
+    h, w = arr.shape
+    api.SetImageBytes(arr.tobytes(), w, h, 1, w)  # copied into a Pix; the bytes can go right away
+    return api.GetUTF8Text()
+
+def _ocr_page(page: tuple[bytes, tuple[int, int], str]) -> str:
+    # runs in a pool worker; pages travel as raw pixels rather than pickled PIL objects
+    raw, size, mode = page
+    return _ocr_image(Image.frombytes(mode, size, raw))
+
+def _ocr_pages(pages: List[Image.Image]) -> List[str]:
+    gray = (p.convert("L") for p in pages)  # also drops palettes tobytes() can't carry
+    jobs = [(g.tobytes(), g.size, g.mode) for g in gray]
+    return list(_get_pool().map(_ocr_page, jobs))
 
 def ocr_any(path: str) -> str:
-    with open(path, "rb") as fh:
-        data = fh.read()
-    try:
-        pages = convert_from_bytes(data, dpi=300)
-        texts = [_ocr_image(p) for p in pages]
-        return "\n\n".join(texts)
-    except Exception:
-        im = Image.open(io.BytesIO(data))
-        return _ocr_image(im)
+    if path.lower().endswith(".pdf"):
+        # 200 DPI grayscale is plenty for 10 pt BOL print and ~2.25x fewer pixels than 300 DPI RGB
+        pages = convert_from_path(path, dpi=200, fmt="png", grayscale=True,
+                                  thread_count=os.cpu_count(), use_pdftocairo=True)
+    else:
+        pages = [Image.open(path)]
+    return "\n\n".join(_ocr_pages(pages))
+
+def cached_ocr(path: str) -> str:
+    # OCR text keyed by file content, so re-runs over unchanged samples skip Tesseract;
+    # OCR_CACHE=0 forces a fresh OCR
+    if os.getenv("OCR_CACHE", "1") == "0":
+        return ocr_any(path)
+    hasher = blake3()
+    hasher.update_mmap(path)  # hashes straight from the page cache, no full read into memory
+    cache_path = os.path.join(OCR_CACHE_DIR, f"{OCR_CACHE_VERSION}-{hasher.hexdigest()}.txt")
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            return f.read()
+    text = ocr_any(path)
+    os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+    # write-then-rename so a crash mid-write never leaves truncated text in the cache
+    fd, tmp_path = tempfile.mkstemp(dir=OCR_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, cache_path)
+    return text
+
+def _first_hits(out: dict, pattern, text: str, endpos: int) -> None:
+    pending = set(pattern.groupindex)
+    for m in pattern.finditer(text, 0, endpos):  # pos/endpos bound the scan without slicing
+        k = m.lastgroup
+        if k not in pending:
+            continue  # first hit wins
+        v = m.group(k)
+        if k == "date":
+            v = to_iso_date(v)
+        elif k in WEIGHT_FIELDS:
+            v = int(v.replace(",", ""))
+        if v is not None:
+            out[k] = v
+            pending.discard(k)
+            if not pending:
+                break
 
 def extract_regex(text: str) -> dict:
-    out = {k: None for k in [
-        "waybill_number","date","shipper","carrier","po_number","material",
-        "gross_weight","tare_weight","net_weight","location","ticket_number",
-        "vehicle_number","signature_present","radiation_checked"
-    ]}
-    if m := DATE_RE.search(text):
-        out["date"] = to_iso_date(m.group(1))
+    out = {k: None for k in FIELDS}
+    _first_hits(out, HEADER_RE, text, min(len(text), HEADER_CHARS))
+    _first_hits(out, WEIGHT_RE, text, len(text))
     return out
 
-def write_waybill_row(data: dict, source_file: str) -> None:
-    header = [
-        "Waybill #","Date","Shipper","Carrier","PO #","Material",
-        "Gross Wt","Tare Wt","Net Wt","Location","Ticket #","Vehicle #",
-        "Signature Present","Radiation Checked","Source File"
-    ]
-    file_exists = os.path.exists(WAYBILLS_CSV)
-    with open(WAYBILLS_CSV, "a", newline="") as f:
-        w = csv.writer(f)
-        if not file_exists:
-            w.writerow(header)
-        w.writerow([
-            data.get("waybill_number") or "",
-            data.get("date") or "",
-            data.get("shipper") or "",
-            data.get("carrier") or "",
-            data.get("po_number") or "",
-            data.get("material") or "",
-            data.get("gross_weight") or "",
-            data.get("tare_weight") or "",
-            data.get("net_weight") or "",
-            data.get("location") or "",
-            data.get("ticket_number") or "",
-            data.get("vehicle_number") or "",
-            data.get("signature_present") or "",
-            data.get("radiation_checked") or "",
-            source_file,
-        ])
-
-def process_one(path: str, idx: int) -> None:
+def fill_from_text_if_missing(data: dict, text: str) -> dict:
+    for k, v in extract_regex(text).items():
+        if v is not None and data.get(k) in (None, ""):
+            data[k] = v
+    return data
+
+# CSV column label per extracted field; FIELDS (shared with the LLM prompt) fixes the order
+CSV_LABELS = {
+    "waybill_number": "Waybill #", "date": "Date", "shipper": "Shipper", "carrier": "Carrier",
+    "po_number": "PO #", "material": "Material", "gross_weight": "Gross Wt",
+    "tare_weight": "Tare Wt", "net_weight": "Net Wt", "location": "Location",
+    "ticket_number": "Ticket #", "vehicle_number": "Vehicle #",
+    "signature_present": "Signature Present", "radiation_checked": "Radiation Checked",
+}
+WAYBILL_HEADER = [CSV_LABELS[k] for k in FIELDS] + ["Source File"]
+
+class CSVSink:
+    """Append-only CSV held open for the whole run; one buffered handle instead of open/close per file."""
+
+    def __init__(self, path: str, header: List[str]):
+        self.path = path
+        self.header = header
+
+    def __enter__(self) -> "CSVSink":
+        self.f = open(self.path, "a", newline="", buffering=1 << 20)
+        self.w = csv.writer(self.f)
+        if os.path.getsize(self.path) == 0:
+            self.w.writerow(self.header)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.f.close()
+
+    def write_row(self, row: list) -> None:
+        self.w.writerow(row)
+
+def write_waybill_row(sink: CSVSink, data: dict, source_file: str) -> None:
+    sink.write_row([data.get(k) or "" for k in FIELDS] + [source_file])
+
+def ocr_one(path: str) -> str:
     print("Processing", path)
-    text = ocr_any(path)
+    text = cached_ocr(path)
 
     # DEBUG: save OCR text
     with open(os.path.join(DEBUG_DIR, f"ocr_{os.path.basename(path)}.txt"), "w", encoding="utf-8") as df:
         df.write(text[:20000])
+    return text
 
+async def run_llm(text: str) -> tuple[dict, bool]:
     mode = os.getenv("EXTRACTOR_MODE", "REGEX").upper()
-    used_llm = False
     if mode == "OPENAI":
         try:
-            print("[process_one] Using OpenAI extractor…")
-            data = asyncio.get_event_loop().run_until_complete(extract_openai(text))
-            used_llm = True
+            print("[run_llm] Using OpenAI extractor…")
+            return await extract_openai(text), True
         except RuntimeError as e:
             if "INSUFFICIENT_QUOTA" in str(e):
-                print("[process_one] OpenAI quota exhausted — falling back to regex for this file.")
-                data = extract_regex(text)
-            else:
-                raise
-    else:
-        print("[process_one] Using regex extractor (MODE != OPENAI).")
-        data = extract_regex(text)
+                print("[run_llm] OpenAI quota exhausted — falling back to regex for this file.")
+                return extract_regex(text), False
+            raise
+    print("[run_llm] Using regex extractor (MODE != OPENAI).")
+    return extract_regex(text), False
 
+def batch_mode() -> bool:
+    # EXTRACTOR_MODE=OPENAI_BATCH, or OPENAI_BATCH_MODE=1 on top of any mode
+    return (os.getenv("EXTRACTOR_MODE", "REGEX").upper() == "OPENAI_BATCH"
+            or os.getenv("OPENAI_BATCH_MODE", "0") == "1")
+
+async def run_batch(texts: List[str]) -> List[tuple[dict, bool]]:
+    # batch mode: one Batch API job for the whole run — half price, no RPM pressure
+    results = []
+    for i, (text, data) in enumerate(zip(texts, await extract_openai_batch(texts))):
+        if data is not None:
+            results.append((data, True))
+        else:
+            print(f"[run_batch] No batch result for req-{i} — falling back to regex for this file.")
+            results.append((extract_regex(text), False))
+    return results
+
+def finish_one(sink: CSVSink, path: str, idx: int, text: str, data: dict, used_llm: bool) -> None:
     # NEW: save whatever the LLM gave us (or regex result) before gap-fill
     base = os.path.splitext(os.path.basename(path))[0]
     job_id = f"{base}-{idx:04d}"
     os.makedirs(JSON_DIR, exist_ok=True)
-    with open(os.path.join(DEBUG_DIR, f"llm_{job_id}.json"), "w", encoding="utf-8") as df:
-        json.dump(data, df, indent=2)
+    with open(os.path.join(DEBUG_DIR, f"llm_{job_id}.json"), "wb") as df:
+        df.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
     # Fill any missing fields from OCR text via lightweight patterns
     data = fill_from_text_if_missing(data, text)
@@ -125,18 +276,57 @@ def process_one(path: str, idx: int) -> None:
         pass
 
     # Save final JSON (post gap-fill)
-    with open(os.path.join(JSON_DIR, f"{job_id}.json"), "w") as f:
-        json.dump(data, f, indent=2)
+    with open(os.path.join(JSON_DIR, f"{job_id}.json"), "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
     # Append one row to the single CSV
-    write_waybill_row(data, source_file=os.path.basename(path))
+    write_waybill_row(sink, data, source_file=os.path.basename(path))
     print(f"Done → {job_id} (LLM used: {used_llm})")
 
 
-def main() -> None:
-    files = sorted(glob.glob("samples/*.pdf")) \
-          + sorted(glob.glob("samples/*.png")) \
-          + sorted(glob.glob("samples/*.jpg"))
+SAMPLE_EXTS = {".pdf", ".png", ".jpg"}
+
+def list_samples(folder: str = "samples") -> List[str]:
+    # one directory pass instead of a glob per extension
+    if not os.path.isdir(folder):
+        return []
+    with os.scandir(folder) as it:
+        return sorted(e.path for e in it
+                      if e.is_file() and os.path.splitext(e.name)[1].lower() in SAMPLE_EXTS)
+
+async def run_batch_mode(sink: CSVSink, files: List[str]) -> None:
+    # the Batch API wants every document up front
+    texts = [await asyncio.to_thread(ocr_one, path) for path in files]
+    results = await run_batch(texts)
+    for idx, (path, text, (data, used_llm)) in enumerate(zip(files, texts, results), 1):
+        finish_one(sink, path, idx, text, data, used_llm)
+
+async def run_pipeline(sink: CSVSink, files: List[str]) -> None:
+    # pipeline: OCR of file N+1 (pages fan out over the process pool, driven from a
+    # thread so the loop stays free) overlaps the LLM calls for the files before it.
+    # extract_openai itself bounds in-flight requests and paces them to OPENAI_RPM, so
+    # the worker count only needs to match its concurrency.
+    concurrency = int(os.getenv("OPENAI_CONCURRENCY", "16"))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+
+    async def ocr_worker() -> None:
+        for idx, path in enumerate(files, 1):
+            text = await asyncio.to_thread(ocr_one, path)
+            await queue.put((idx, path, text))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def llm_worker() -> None:
+        while (item := await queue.get()) is not None:
+            idx, path, text = item
+            data, used_llm = await run_llm(text)
+            # persisted on the loop thread, so CSV rows never interleave
+            finish_one(sink, path, idx, text, data, used_llm)
+
+    await asyncio.gather(ocr_worker(), *(llm_worker() for _ in range(concurrency)))
+
+async def main_async() -> None:
+    files = list_samples()
 
     if not files:
         print("No sample files in samples/")
@@ -146,11 +336,39 @@ def main() -> None:
     files = files[:1]
 
     os.makedirs(OUT_DIR, exist_ok=True)
-    for idx, path in enumerate(files, 1):
-        process_one(path, idx)
-        time.sleep(3)
+    with CSVSink(WAYBILLS_CSV, WAYBILL_HEADER) as sink:
+        try:
+            if batch_mode() or os.getenv("EXTRACTOR_MODE", "REGEX").upper() == "OPENAI":
+                # tokenizer load can hit the network; keep it off the loop and out of the workers
+                await extract_openai_warmup()
+            if batch_mode():
+                await run_batch_mode(sink, files)
+            else:
+                await run_pipeline(sink, files)
+        finally:
+            # both paths share llm_extract's session
+            await extract_openai_close()
+            _shutdown_pool()
 
-if __name__ == "__main__":
-    main()
+def _start_logging() -> logging.handlers.QueueListener:
+    # llm_extract / llm_batch log through the queue; a background thread does the
+    # actual stdout writes, so retry storms never block the event loop on I/O
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    out = logging.StreamHandler()
+    out.setFormatter(logging.Formatter("[%(name)s] %(levelname)s %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(q))
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    listener = logging.handlers.QueueListener(q, out)
+    listener.start()
+    return listener
 
+def main() -> None:
+    listener = _start_logging()
+    try:
+        asyncio.run(main_async())
+    finally:
+        listener.stop()  # flushes whatever is still queued
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# llm_batch.py — OpenAI Batch API path: one JSONL job for the whole run, half the token price
+import os, asyncio, aiohttp, orjson, logging
+from typing import AsyncIterator
+
+from llm_extract import build_payload, _get_session, _coerce_json
+
+log = logging.getLogger("llm_batch")
+
+API = "https://api.openai.com/v1"
+ENDPOINT = "/v1/chat/completions"
+SLOW = aiohttp.ClientTimeout(total=300)  # file upload/download can outlast a chat call
+
+def _jsonl(items: list[tuple[str, str]]) -> bytes:
+  lines = (
+    orjson.dumps({"custom_id": id_, "method": "POST", "url": ENDPOINT, "body": build_payload(text)})
+    for id_, text in items
+  )
+  return b"\n".join(lines) + b"\n"
+
+async def submit_batch(items: list[tuple[str, str]]) -> str:
+  """Upload one request per (custom_id, ocr_text) pair and start a 24h batch; returns the batch id."""
+  session = _get_session()
+  form = aiohttp.FormData()
+  form.add_field("purpose", "batch")
+  form.add_field("file", _jsonl(items), filename="waybills.jsonl", content_type="application/jsonl")
+  async with session.post(f"{API}/files", data=form, timeout=SLOW, raise_for_status=True) as resp:
+    file_id = orjson.loads(await resp.read())["id"]
+
+  async with session.post(
+    f"{API}/batches", raise_for_status=True,
+    json={"input_file_id": file_id, "endpoint": ENDPOINT, "completion_window": "24h"},
+  ) as resp:
+    return orjson.loads(await resp.read())["id"]
+
+async def wait_and_parse(batch_id: str) -> AsyncIterator[tuple[str, dict | None]]:
+  """Poll until the batch finishes, then yield (custom_id, fields); fields is None for failed requests."""
+  session = _get_session()
+  poll_s = float(os.getenv("OPENAI_BATCH_POLL", "60"))
+
+  while True:
+    async with session.get(f"{API}/batches/{batch_id}", raise_for_status=True) as resp:
+      batch = orjson.loads(await resp.read())
+    status = batch["status"]
+    if status == "completed":
+      break
+    if status in ("failed", "expired", "cancelled"):
+      raise RuntimeError(f"OpenAI batch {batch_id} ended with status {status}: {batch.get('errors')}")
+    log.info("batch=%s status=%s next_poll=%.0fs", batch_id, status, poll_s)
+    await asyncio.sleep(poll_s)
+
+  output_file_id = batch.get("output_file_id")
+  if not output_file_id:  # every request failed; details live in error_file_id
+    return
+  async with session.get(f"{API}/files/{output_file_id}/content", timeout=SLOW, raise_for_status=True) as resp:
+    output = await resp.read()  # rows are parsed straight from bytes
+
+  for line in output.splitlines():
+    if not line.strip():
+      continue
+    row = orjson.loads(line)
+    response = row.get("response") or {}
+    if row.get("error") or response.get("status_code") != 200:
+      log.warning("request=%s failed: %s", row.get("custom_id"), row.get("error") or response.get("status_code"))
+      yield row["custom_id"], None
+      continue
+    try:
+      fields = _coerce_json(response["body"]["choices"][0]["message"]["content"])
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+      # one bad row must not sink a paid-for batch; the caller falls back to regex for it
+      log.warning("request=%s unparseable content: %s", row["custom_id"], e)
+      fields = None
+    yield row["custom_id"], fields
+
+async def extract_openai_batch(texts: list[str]) -> list[dict | None]:
+  """Run every text through one batch job; results come back in input order, None where a request failed."""
+  ids = [f"req-{i}" for i in range(len(texts))]
+  batch_id = await submit_batch(list(zip(ids, texts)))
+  log.info("batch=%s submitted requests=%d", batch_id, len(texts))
+  parsed = {custom_id: fields async for custom_id, fields in wait_and_parse(batch_id)}
+  return [parsed.get(id_) for id_ in ids]
@@ -1,11 +1,37 @@
 # llm_extract.py — OpenAI caller, returns Waybill fields; robust JSON; fail-fast on quota
-import os, json, httpx, time, random
+import os, re, aiohttp, random, asyncio, orjson, time, hashlib, copy, email.utils, logging
+from datetime import datetime, timezone
+from collections import OrderedDict
 
-FIELDS = [
+log = logging.getLogger("llm_extract")
+
+FIELDS = (
   "waybill_number","date","shipper","carrier","po_number","material",
   "gross_weight","tare_weight","net_weight","location","ticket_number",
   "vehicle_number","signature_present","radiation_checked"
-]
+)
+
+def reload_config() -> None:
+  """Read the OPENAI_* settings from the environment. Runs once at import so the hot path
+  only reads module globals; call again after changing the env (e.g. in tests). The key and
+  concurrency are baked into the shared session, so close it with extract_openai_close() first."""
+  if _session is not None:
+    raise RuntimeError("reload_config() with an open session; await extract_openai_close() first")
+  global _API_KEY, _MODEL, _MAX_ATTEMPTS, _BASE_SLEEP, _CONCURRENCY, _RPM, _RETRY_AFTER_MAX, _CACHE_ENABLED
+  global _MAX_INPUT_TOKENS, _enc, _STREAM
+  _API_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
+  _MODEL = (os.getenv("OPENAI_MODEL") or "gpt-4o").strip()  # switch to gpt-5 later if you have access
+  _MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
+  _BASE_SLEEP = float(os.getenv("OPENAI_BASE_SLEEP", "2.0"))
+  _CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "16"))
+  _RPM = float(os.getenv("OPENAI_RPM", "500"))
+  _RETRY_AFTER_MAX = float(os.getenv("OPENAI_RETRY_AFTER_MAX", "30"))
+  _CACHE_ENABLED = os.getenv("OPENAI_CACHE_ENABLED", "1") != "0"
+  _MAX_INPUT_TOKENS = int(os.getenv("OPENAI_MAX_INPUT_TOKENS", "3000"))
+  _enc = None  # tokenizer depends on _MODEL
+  _STREAM = os.getenv("OPENAI_STREAM", "0") == "1"
+  if os.getenv("OPENAI_STRICT"):
+    _api_key()  # fail at startup rather than on the first document
 
 def _prompt():
   return (
@@ -19,71 +45,281 @@ def _prompt():
     "• Keep output strictly JSON; no extra text.\n"
   )
 
-def _coerce_json(s: str):
+# built once: every payload shares these (they are only ever serialised, never mutated)
+_PROMPT = _prompt()
+_SYSTEM_MSG = {"role": "system", "content": _PROMPT}
+_RESPONSE_FORMAT = {"type": "json_object"}  # broader support than json_schema
+
+_JSON_BLOCK = re.compile(rb"\{.*\}", re.DOTALL)  # outermost {...} when the model wraps its JSON
+
+def _coerce_json(s: str | bytes):
+  b = s.encode() if isinstance(s, str) else s
   try:
-    return json.loads(s)
-  except Exception:
-    a, b = s.find("{"), s.rfind("}")
-    if a != -1 and b != -1 and b > a:
-      return json.loads(s[a:b+1])
+    return orjson.loads(b)
+  except orjson.JSONDecodeError:
+    if m := _JSON_BLOCK.search(b):
+      return orjson.loads(m.group(0))
     raise
 
-async def extract_openai(ocr_text: str) -> dict:
-  api_key = (os.getenv("OPENAI_API_KEY") or "").strip()
-  model = (os.getenv("OPENAI_MODEL") or "gpt-4o").strip()  # switch to gpt-5 later if you have access
-  if not api_key:
+# in-process LRU of parsed responses, so re-extracting the same document in a run is free
+_CACHE: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_CACHE_MAX = 1024
+_CACHE_TTL = 24 * 3600
+
+def _cache_get(key: str) -> dict | None:
+  hit = _CACHE.get(key)
+  if hit is None:
+    return None
+  stored_at, result = hit
+  if time.time() - stored_at > _CACHE_TTL:
+    del _CACHE[key]
+    return None
+  _CACHE.move_to_end(key)
+  return copy.deepcopy(result)  # callers mutate the dict during gap-fill
+
+def _cache_put(key: str, result: dict) -> None:
+  _CACHE[key] = (time.time(), copy.deepcopy(result))
+  _CACHE.move_to_end(key)
+  if len(_CACHE) > _CACHE_MAX:
+    _CACHE.popitem(last=False)
+
+_session: aiohttp.ClientSession | None = None
+_sem: asyncio.Semaphore | None = None
+_next_slot = 0.0  # loop.time() at which the next request may start
+_JSON_HEADERS = {"Content-Type": "application/json"}
+BACKOFF_CAP = 60.0  # seconds
+
+def _get_session() -> aiohttp.ClientSession:
+  # one keep-alive aiohttp session for the whole process; aiohttp keeps scaling where
+  # httpx.AsyncClient plateaus past ~20 concurrent requests. Call from a running loop.
+  global _session, _sem
+  if _session is None:
+    # caps in-flight calls so a wide asyncio.gather can't exhaust the pool or start a 429 storm
+    _sem = asyncio.Semaphore(_CONCURRENCY)
+    _session = aiohttp.ClientSession(
+      timeout=aiohttp.ClientTimeout(total=60, connect=10),
+      # no HTTP/2 in aiohttp, so keep the pool just wide enough for the semaphore (plus a few
+      # un-gated Batch API calls) and let idle sockets live long enough to be reused
+      connector=aiohttp.TCPConnector(limit=_CONCURRENCY + 4, limit_per_host=_CONCURRENCY + 4,
+                                     ttl_dns_cache=300, keepalive_timeout=60),
+      # the key is read once here and rides on every request from the session itself;
+      # Content-Type is left to each request so the Batch API's multipart upload works
+      headers={"Authorization": f"Bearer {_api_key()}"},
+    )
+  return _session
+
+async def extract_openai_close() -> None:
+  """Close the shared session; await once at shutdown while the event loop is still running."""
+  global _session, _sem
+  if _session is not None:
+    await _session.close()
+    _session = None
+    _sem = None
+
+async def _pace() -> None:
+  # minimum spacing between request starts, smoothing traffic to the account's RPM tier
+  # (OPENAI_RPM=0 disables). The slot is reserved before sleeping, so concurrent callers queue up.
+  global _next_slot
+  if _RPM <= 0:
+    return
+  now = asyncio.get_running_loop().time()
+  start = max(now, _next_slot)
+  _next_slot = start + 60.0 / _RPM
+  if start > now:
+    await asyncio.sleep(start - now)
+
+def _api_key() -> str:
+  if not _API_KEY:
     raise RuntimeError("OPENAI_API_KEY missing. Add it as a repo secret and pass it in the workflow env.")
+  return _API_KEY
 
-  text = ocr_text[:9000]  # keep payload modest
-  url = "https://api.openai.com/v1/chat/completions"
-  payload = {
-    "model": model,
+_enc = None
+_SPACE_RUN = re.compile(r"[ \t]{2,}")  # OCR pads columns with runs of spaces
+
+def _encoder():
+  """tiktoken encoding for _MODEL, or False if it can't be loaded. The first call may download
+  the BPE table (blocking), so warm it with extract_openai_warmup() before the hot path."""
+  global _enc
+  if _enc is None:
+    try:
+      import tiktoken
+      try:
+        _enc = tiktoken.encoding_for_model(_MODEL)
+      except KeyError:  # model name tiktoken doesn't know yet
+        _enc = tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # no network / no cache: cap by characters instead of failing the run
+      log.warning("tiktoken unavailable (%s); capping input by characters", e)
+      _enc = False
+  return _enc
+
+async def extract_openai_warmup() -> None:
+  """Load the tokenizer off the event loop; await once at startup before extracting."""
+  await asyncio.to_thread(_encoder)
+
+def _trim(ocr_text: str) -> str:
+  """Collapse space runs and cap the text at OPENAI_MAX_INPUT_TOKENS model tokens."""
+  # pre-slice so a huge document isn't tokenised in full; 8 chars/token is a heuristic
+  # margin (English OCR averages ~4), not a hard bound on token width
+  text = _SPACE_RUN.sub(" ", ocr_text[:_MAX_INPUT_TOKENS * 8])
+  enc = _encoder()
+  if not enc:
+    return text[:_MAX_INPUT_TOKENS * 4]
+  ids = enc.encode(text, disallowed_special=())
+  return text if len(ids) <= _MAX_INPUT_TOKENS else enc.decode(ids[:_MAX_INPUT_TOKENS])
+
+def build_payload(ocr_text: str) -> dict:
+  """chat/completions request body for one document; shared with the Batch API path."""
+  text = _trim(ocr_text)
+  return {
+    "model": _MODEL,
     "temperature": 0.1,
-    "messages": [
-      {"role":"system","content": _prompt()},
-      {"role":"user","content": text}
-    ],
-    # broader support than json_schema
-    "response_format": {"type": "json_object"}
+    "messages": [_SYSTEM_MSG, {"role":"user","content": text}],
+    "response_format": _RESPONSE_FORMAT,
   }
-  headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
 
-  max_attempts = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
-  base_sleep   = float(os.getenv("OPENAI_BASE_SLEEP", "2.0"))
+def _parse_retry_after(v: str | None) -> float | None:
+  """Seconds to wait per a Retry-After header (delta-seconds or HTTP-date), not yet clamped
+  to OPENAI_RETRY_AFTER_MAX; None if absent or unparseable."""
+  if not v:
+    return None
+  try:
+    secs = float(v)
+  except ValueError:
+    try:
+      dt = email.utils.parsedate_to_datetime(v)
+    except (TypeError, ValueError):
+      return None
+    if dt.tzinfo is None:
+      dt = dt.replace(tzinfo=timezone.utc)
+    secs = (dt - datetime.now(timezone.utc)).total_seconds()
+  return max(0.0, secs)
 
-  async with httpx.AsyncClient(timeout=30) as client:
-    for attempt in range(1, max_attempts + 1):
-      resp = await client.post(url, headers=headers, json=payload)
-      status = resp.status_code
+_LBRACE, _RBRACE, _QUOTE, _BSLASH = b"{}\"\\"
 
-      try:
-        body = resp.json()
-      except Exception:
-        body = {}
-      body_text = resp.text
-
-      if status == 200:
-        content = body["choices"][0]["message"]["content"]
-        return _coerce_json(content)
-
-      # fail fast if out of quota
-      if status in (429, 400) and isinstance(body, dict):
-        err = (body.get("error") or {})
-        if err.get("type") == "insufficient_quota" or "quota" in (err.get("message","").lower()):
-          raise RuntimeError("INSUFFICIENT_QUOTA: Your OpenAI plan/credits are exhausted.")
-
-      # gentle backoff for throttling/server errors
-      if status == 429 or 500 <= status < 600:
-        if attempt == max_attempts:
-          resp.raise_for_status()
-        retry_after = resp.headers.get("Retry-After")
-        sleep_s = float(retry_after) if retry_after else base_sleep * (2 ** (attempt - 1)) + random.uniform(0, 0.6)
-        print(f"[extract_openai] HTTP {status} attempt {attempt}/{max_attempts}; backing off {sleep_s:.1f}s…")
-        time.sleep(sleep_s)
-        continue
-
-      # other 4xx
-      if 400 <= status < 500:
-        raise httpx.HTTPStatusError(f"OpenAI HTTP {status}. Body: {body_text[:300]}", request=resp.request, response=resp)
-
-      resp.raise_for_status()
+async def _read_stream(resp: aiohttp.ClientResponse) -> bytes:
+  """Collect the delta.content of an SSE chat stream up to the close of the top-level JSON
+  object. The rest of the stream is drained, not parsed: leaving it unread would make
+  aiohttp drop the keep-alive connection."""
+  out = bytearray()
+  depth, in_str, esc, closed = 0, False, False, False
+  async for line in resp.content:
+    if closed or not line.startswith(b"data:"):
+      continue
+    data = line[5:].strip()
+    if data == b"[DONE]":
+      break
+    choices = orjson.loads(data).get("choices") or []
+    piece = ((choices[0].get("delta") or {}).get("content") or "").encode() if choices else b""
+    # brace depth outside string literals; UTF-8 continuation bytes never match ASCII
+    for i, c in enumerate(piece):
+      if in_str:
+        if esc:
+          esc = False
+        elif c == _BSLASH:
+          esc = True
+        elif c == _QUOTE:
+          in_str = False
+      elif c == _QUOTE:
+        in_str = True
+      elif c == _LBRACE:
+        depth += 1
+      elif c == _RBRACE:
+        depth -= 1
+        if depth == 0:
+          piece, closed = piece[:i + 1], True  # drop anything the model adds after the object
+          break
+    out += piece
+  return bytes(out)
+
+async def _post_with_retries(session: aiohttp.ClientSession, body_bytes: bytes) -> dict:
+  url = "https://api.openai.com/v1/chat/completions"
+  max_attempts, base_sleep = _MAX_ATTEMPTS, _BASE_SLEEP
+  # decorrelated jitter (sleep = uniform(base, prev*3), capped): parallel workers that hit
+  # a 429 together spread out instead of waking in lockstep and re-storming
+  prev_sleep = base_sleep
+  # a Retry-After we clamp means we knowingly come back early; that retry is on us, so it
+  # doesn't spend one of the attempts (at most max_attempts such free retries per call)
+  free_retries = max_attempts
+
+  attempt = 0
+  while attempt < max_attempts:
+    attempt += 1
+    await _pace()
+    try:
+      async with session.post(url, data=body_bytes, headers=_JSON_HEADERS) as resp:
+        status = resp.status
+        if status == 200 and _STREAM:
+          raw = await _read_stream(resp)  # message content itself, not a chat completion
+        else:
+          raw = await resp.read()  # one pass over the body; decoded to str only on error paths
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+      # dropped connection / timeout: retry on the same schedule, without blocking the loop
+      if attempt == max_attempts:
+        raise
+      sleep_s = prev_sleep = min(BACKOFF_CAP, random.uniform(base_sleep, prev_sleep * 3))
+      log.warning("error=%s attempt=%d/%d backoff=%.1f", type(e).__name__, attempt, max_attempts, sleep_s)
+      await asyncio.sleep(sleep_s)
+      continue
+
+    if status == 200 and _STREAM:
+      return _coerce_json(raw)
+
+    try:
+      body = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+      body = {}
+
+    if status == 200:
+      content = body["choices"][0]["message"]["content"]
+      return _coerce_json(content)
+
+    # fail fast if out of quota
+    if status in (429, 400) and isinstance(body, dict):
+      err = (body.get("error") or {})
+      if err.get("type") == "insufficient_quota" or "quota" in (err.get("message","").lower()):
+        raise RuntimeError("INSUFFICIENT_QUOTA: Your OpenAI plan/credits are exhausted.")
+
+    # gentle backoff for throttling/server errors
+    if status == 429 or 500 <= status < 600:
+      if attempt == max_attempts:
+        resp.raise_for_status()
+      retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+      clamped = retry_after is not None and retry_after > _RETRY_AFTER_MAX
+      if retry_after is not None:
+        sleep_s = min(retry_after, _RETRY_AFTER_MAX)
+      else:
+        sleep_s = prev_sleep = min(BACKOFF_CAP, random.uniform(base_sleep, prev_sleep * 3))
+      log.warning("http_status=%d attempt=%d/%d %s=%.1f", status, attempt, max_attempts,
+                  "retry_after" if retry_after is not None else "backoff", sleep_s)
+      if clamped and free_retries:
+        free_retries -= 1
+        attempt -= 1
+      await asyncio.sleep(sleep_s)
+      continue
+
+    # other 4xx
+    if 400 <= status < 500:
+      body_text = raw[:400].decode("utf-8", "replace")  # bounded snippet; never decode a huge body
+      raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=status,
+                                        message=f"OpenAI HTTP {status}. Body: {body_text}", headers=resp.headers)
+
+    resp.raise_for_status()
+
+async def extract_openai(ocr_text: str) -> dict:
+  if _CACHE_ENABLED:
+    key = hashlib.sha256(f"{_MODEL}\0{_PROMPT}\0{ocr_text}".encode()).hexdigest()
+    if (cached := _cache_get(key)) is not None:
+      return cached  # hits skip tokenising and payload building entirely
+
+  payload = build_payload(ocr_text)
+  if _STREAM:
+    payload["stream"] = True
+
+  session = _get_session()
+  async with _sem:
+    result = await _post_with_retries(session, orjson.dumps(payload))  # encoded once, reused across retries
+  if _CACHE_ENABLED:
+    _cache_put(key, result)
+  return result
+
+reload_config()